@@ -6,92 +6,239 @@ Perfect for cybersecurity learning and data concealment practice.
 """
 
 from PIL import Image
+import numpy as np
 import argparse
+import getpass
+import hashlib
+import hmac
+import math
+import struct
+import zlib
 import sys
 import os
 
+try:
+    from numba import njit, prange
+except ImportError:  # Numba is optional, NumPy kernels are used without it
+    njit = None
+
+try:
+    from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+except ImportError:  # cryptography is optional, only needed for password-protected messages
+    Cipher = None
+
+BAND_HEIGHT = 64  # Rows of pixels processed per step when embedding or scanning
+# Keeps every full band a whole number of bytes (BAND_HEIGHT * 3 bits per column),
+# which _scan_for_delimiter relies on to pack each band on its own
+assert BAND_HEIGHT % 8 == 0, "BAND_HEIGHT must be a multiple of 8"
+LSB_CLEAR_MASK = 0xFEFEFEFEFEFEFEFE  # Clears the LSB of all 8 bytes in a 64-bit word
+CHI_SQUARE_THRESHOLD = 0.5  # Prefix embedding probability at which LSBs count as detected
+CHI_SQUARE_ROWS = 12  # Most prefixes listed in the chi-square report
+
+# Payload header: magic, flags, payload length in bytes
+HEADER = struct.Struct('>4sBI')
+MAGIC = b'HIDr'
+FLAG_ZLIB = 0x01  # Payload is zlib-compressed
+FLAG_AES = 0x02  # Payload is nonce, AES-256-CTR ciphertext, HMAC-SHA256 tag
+KNOWN_FLAGS = FLAG_ZLIB | FLAG_AES
+
+NONCE_SIZE = 16
+TAG_SIZE = 16  # HMAC-SHA256 tag truncated to 128 bits
+KDF_ITERATIONS = 200_000  # PBKDF2-HMAC-SHA256 rounds used to derive the AES and HMAC keys
+
+
+def _embed_lsb(flat, bits):
+    """Overwrite the LSBs of the first len(bits) values in flat (in place)
+    
+    Groups of 8 values are processed as 64-bit words (SWAR). Each bit is already
+    stored as a 0/1 byte, so 8 of them viewed as a uint64 line up with the lanes.
+    """
+    whole = bits.size - bits.size % 8
+    _embed_words(flat[:whole].view(np.uint64), bits[:whole].view(np.uint64))
+    
+    # Leftover values that don't fill a whole word
+    tail = slice(whole, bits.size)
+    flat[tail] = (flat[tail] & 0xFE) | bits[tail]
+
+
+def _embed_words(words, bit_words):
+    """Clear the LSB of every byte lane in words and OR in bit_words (in place)"""
+    words &= np.uint64(LSB_CLEAR_MASK)
+    words |= bit_words
+
+
+def _extract_lsb(flat):
+    """Return the LSB of every value in flat"""
+    return flat & 1
+
+
+if njit is not None:
+    @njit(cache=True, parallel=True)
+    def _embed_words(words, bit_words):
+        for i in prange(words.size):
+            words[i] = (words[i] & LSB_CLEAR_MASK) | bit_words[i]
+
+
+def _chi_square_lsb(counts):
+    """Chi-square test for LSB embedding on one channel's 256-bin histogram (Westfeld & Pfitzmann)
+    
+    LSB embedding evens out the counts of each value pair (2k, 2k+1). Returns the
+    statistic, its degrees of freedom and the probability that the LSBs carry
+    embedded data, using the Wilson-Hilferty approximation of the chi-square CDF.
+    """
+    pairs = np.asarray(counts, dtype=np.float64).reshape(128, 2)
+    expected = pairs.mean(axis=1)
+    used = expected > 0
+    chi2 = float((((pairs[used, 0] - expected[used]) ** 2) / expected[used]).sum())
+    dof = int(used.sum()) - 1
+    if dof < 1:
+        return chi2, dof, 0.0
+    
+    # P(X >= chi2) for X ~ chi-square(dof), high when the pairs are suspiciously even
+    z = ((chi2 / dof) ** (1 / 3) - (1 - 2 / (9 * dof))) / math.sqrt(2 / (9 * dof))
+    return chi2, dof, 0.5 * math.erfc(z / math.sqrt(2))
+
+
+def _derive_keys(password, nonce):
+    """Derive the AES-256 key and HMAC key from the password with PBKDF2 (nonce as salt)"""
+    keys = hashlib.pbkdf2_hmac('sha256', password.encode('utf-8'), nonce, KDF_ITERATIONS, dklen=64)
+    return keys[:32], keys[32:]
+
+
+def _aes_ctr(key, nonce, data):
+    """Encrypt or decrypt data with AES-256-CTR (the same operation in CTR mode)"""
+    if Cipher is None:
+        raise RuntimeError("Password protection requires the 'cryptography' package "
+                           "(pip install cryptography)")
+    
+    crypt = Cipher(algorithms.AES(key), modes.CTR(nonce)).encryptor()
+    return crypt.update(data) + crypt.finalize()
+
+
+def _tag(mac_key, data):
+    """Truncated HMAC-SHA256 of data"""
+    return hmac.new(mac_key, data, hashlib.sha256).digest()[:TAG_SIZE]
+
+
+def _encrypt(password, data, flags):
+    """Return nonce + AES-256-CTR ciphertext + HMAC tag
+    
+    The tag covers the payload header (built from flags) as well as the nonce and
+    ciphertext, so tampering with the flags or length is detected too.
+    """
+    nonce = os.urandom(NONCE_SIZE)
+    aes_key, mac_key = _derive_keys(password, nonce)
+    ciphertext = _aes_ctr(aes_key, nonce, data)
+    header = HEADER.pack(MAGIC, flags, NONCE_SIZE + len(ciphertext) + TAG_SIZE)
+    return nonce + ciphertext + _tag(mac_key, header + nonce + ciphertext)
+
+
+def _decrypt(password, payload, flags):
+    """Check the HMAC tag of an _encrypt() payload and its header, then return the plaintext"""
+    if len(payload) < NONCE_SIZE + TAG_SIZE:
+        raise ValueError("Wrong password or corrupted message")
+    
+    nonce, tag = payload[:NONCE_SIZE], payload[-TAG_SIZE:]
+    aes_key, mac_key = _derive_keys(password, nonce)
+    header = HEADER.pack(MAGIC, flags, len(payload))
+    if not hmac.compare_digest(tag, _tag(mac_key, header + payload[:-TAG_SIZE])):
+        raise ValueError("Wrong password or corrupted message")
+    return _aes_ctr(aes_key, nonce, payload[NONCE_SIZE:-TAG_SIZE])
+
+
 class SteganographyTool:
     def __init__(self):
-        self.delimiter = "###END###"  # Marks the end of hidden message
+        self.delimiter = "###END###"  # Marks the end of messages hidden by older versions
+        self._delimiter_bytes = self.delimiter.encode('utf-8')
     
     def text_to_binary(self, text):
-        """Convert text to binary representation"""
-        return ''.join(format(ord(char), '08b') for char in text)
+        """Convert text to a flat array of bits (UTF-8 encoded)"""
+        return np.unpackbits(np.frombuffer(text.encode('utf-8'), dtype=np.uint8))
     
     def binary_to_text(self, binary):
-        """Convert binary to text"""
-        text = ''
-        for i in range(0, len(binary), 8):
-            byte = binary[i:i+8]
-            if len(byte) == 8:
-                text += chr(int(byte, 2))
-        return text
-    
-    def hide_message(self, image_path, message, output_path):
-        """Hide a message in an image using LSB steganography"""
+        """Convert an array of bits back to text (UTF-8 decoded)"""
+        return np.packbits(binary).tobytes().decode('utf-8', errors='replace')
+    
+    def hide_message(self, image_path, message, output_path, fast=False, password=None):
+        """Hide a message in an image using LSB steganography
+        
+        With fast=True the PNG is written with zlib level 1, which usually encodes
+        several times faster but produces a larger file. With a password the
+        message is encrypted with AES-256-CTR before it is hidden.
+        """
         try:
             # Open the image
             img = Image.open(image_path)
-            img = img.convert('RGB')  # Ensure RGB format
+            img.load()
+            if img.mode != 'RGB':
+                img = img.convert('RGB')  # Ensure RGB format
+            
+            # Compress the message, unless it's too short for that to pay off
+            payload = message.encode('utf-8')
+            flags = 0
+            compressed = zlib.compress(payload, 9)
+            if len(compressed) < len(payload):
+                payload = compressed
+                flags |= FLAG_ZLIB
+            payload_size = len(payload)
+            
+            # Encrypt after compressing, ciphertext doesn't compress
+            if password is not None:
+                if not password:
+                    raise ValueError("Password must not be empty")
+                flags |= FLAG_AES
+                payload = _encrypt(password, payload, flags)
             
-            # Add delimiter to mark end of message
-            message_with_delimiter = message + self.delimiter
-            binary_message = self.text_to_binary(message_with_delimiter)
+            # Prefix the payload with a header holding its length
+            data = HEADER.pack(MAGIC, flags, len(payload)) + payload
+            bits = np.unpackbits(np.frombuffer(data, dtype=np.uint8))
             
             # Get image dimensions
             width, height = img.size
             max_capacity = width * height * 3  # 3 channels (RGB)
             
             # Check if image can hold the message
-            if len(binary_message) > max_capacity:
+            if bits.size > max_capacity:
                 raise ValueError(f"Message too long! Image can hold max {max_capacity} bits, "
-                               f"but message needs {len(binary_message)} bits")
+                               f"but message needs {bits.size} bits")
             
-            # Convert image to list of pixels
-            pixels = list(img.getdata())
+            # Hide message in LSBs one band of rows at a time, only bands holding
+            # message bits are copied out and written back
+            pixels = bytearray(width * BAND_HEIGHT * 3)  # Reused for every band
+            consumed = 0
             
-            # Hide message in LSBs
-            message_index = 0
-            modified_pixels = []
-            
-            for pixel in pixels:
-                r, g, b = pixel
-                
-                # Modify LSB of each color channel if we still have message bits
-                if message_index < len(binary_message):
-                    # Modify red channel LSB
-                    r = (r & 0xFE) | int(binary_message[message_index])
-                    message_index += 1
-                
-                if message_index < len(binary_message):
-                    # Modify green channel LSB
-                    g = (g & 0xFE) | int(binary_message[message_index])
-                    message_index += 1
+            for top in range(0, height, BAND_HEIGHT):
+                if consumed >= bits.size:
+                    break
                 
-                if message_index < len(binary_message):
-                    # Modify blue channel LSB
-                    b = (b & 0xFE) | int(binary_message[message_index])
-                    message_index += 1
+                # Copy the band's pixels into the mutable R,G,B,R,G,B,... byte buffer
+                box = (0, top, width, min(top + BAND_HEIGHT, height))
+                band_size = width * (box[3] - top) * 3
+                pixels[:band_size] = img.crop(box).tobytes()
+                flat = np.frombuffer(pixels, dtype=np.uint8, count=band_size)
                 
-                modified_pixels.append((r, g, b))
+                band_bits = bits[consumed:consumed + band_size]
+                _embed_lsb(flat, band_bits)
+                consumed += band_bits.size
                 
-                # Break if we've embedded the entire message
-                if message_index >= len(binary_message):
-                    # Add remaining unmodified pixels
-                    modified_pixels.extend(pixels[len(modified_pixels):])
-                    break
-            
-            # Create new image with modified pixels
-            stego_img = Image.new('RGB', (width, height))
-            stego_img.putdata(modified_pixels)
+                band = Image.frombuffer('RGB', (width, box[3] - top), memoryview(pixels)[:band_size],
+                                        'raw', 'RGB', 0, 1)
+                img.paste(band, box)
             
             # Save the image
-            stego_img.save(output_path, 'PNG')  # Use PNG to avoid compression artifacts
+            if fast:
+                img.save(output_path, 'PNG', compress_level=1, optimize=False)
+            else:
+                img.save(output_path, 'PNG')  # Use PNG to avoid compression artifacts
             
             print(f"✓ Message successfully hidden in {output_path}")
             print(f"  Original image: {image_path}")
             print(f"  Message length: {len(message)} characters")
-            print(f"  Binary bits used: {len(binary_message)}")
+            if flags & FLAG_ZLIB:
+                print(f"  Compressed size: {payload_size} bytes")
+            if flags & FLAG_AES:
+                print("  Encryption: AES-256-CTR")
+            print(f"  Binary bits used: {bits.size}")
             
         except Exception as e:
             print(f"✗ Error hiding message: {str(e)}")
@@ -99,33 +246,54 @@ class SteganographyTool:
         
         return True
     
-    def extract_message(self, image_path):
-        """Extract hidden message from an image"""
+    def extract_message(self, image_path, password=None):
+        """Extract hidden message from an image
+        
+        The password is only needed for messages that were hidden with one. Giving a
+        password for a message that isn't encrypted is an error, so a payload with its
+        encryption flag stripped isn't returned as if it were authentic.
+        """
         try:
             # Open the image
             img = Image.open(image_path)
-            img = img.convert('RGB')
+            img.load()
+            if img.mode != 'RGB':
+                img = img.convert('RGB')
             
-            # Get all pixels
-            pixels = list(img.getdata())
+            width, height = img.size
+            max_bytes = width * height * 3 // 8
             
-            # Extract LSBs
-            binary_message = ''
+            # Read the header, then exactly as many bytes as it says
+            message = None
+            if max_bytes >= HEADER.size:
+                magic, flags, length = HEADER.unpack(self._read_lsb_bytes(img, 0, HEADER.size))
+                if magic == MAGIC and HEADER.size + length <= max_bytes:
+                    if flags & ~KNOWN_FLAGS:
+                        raise ValueError(f"Unsupported payload flags: {flags:#04x}")
+                    payload = self._read_lsb_bytes(img, HEADER.size, length)
+                    if flags & FLAG_AES:
+                        if not password:
+                            raise ValueError("Message is password protected, a password is required")
+                        payload = _decrypt(password, payload, flags)
+                    elif password:
+                        raise ValueError("Message is not password protected, it can't be authenticated")
+                    if flags & FLAG_ZLIB:
+                        payload = zlib.decompress(payload)
+                    message = payload.decode('utf-8', errors='replace')
             
-            for pixel in pixels:
-                r, g, b = pixel
-                
-                # Extract LSB from each channel
-                binary_message += str(r & 1)  # Red channel LSB
-                binary_message += str(g & 1)  # Green channel LSB
-                binary_message += str(b & 1)  # Blue channel LSB
+            # Images from older versions have no header, look for the delimiter instead
+            if message is None and password:
+                raise ValueError("No password protected message found")
+            if message is None:
+                payload = self._scan_for_delimiter(img)
+                if payload is not None:
+                    try:
+                        message = payload.decode('utf-8')
+                    except UnicodeDecodeError:
+                        # Older versions stored one byte per character
+                        message = payload.decode('latin1')
             
-            # Convert binary to text
-            extracted_text = self.binary_to_text(binary_message)
-            
-            # Find the delimiter to get the actual message
-            if self.delimiter in extracted_text:
-                message = extracted_text.split(self.delimiter)[0]
+            if message is not None:
                 print(f"✓ Message extracted successfully:")
                 print(f"  Hidden message: '{message}'")
                 print(f"  Message length: {len(message)} characters")
@@ -138,11 +306,61 @@ class SteganographyTool:
             print(f"✗ Error extracting message: {str(e)}")
             return None
     
-    def analyze_image_capacity(self, image_path):
-        """Analyze how much data an image can hold"""
+    def _read_lsb_bytes(self, img, start, count):
+        """Read count bytes from the LSB stream of an RGB image, starting at byte start"""
+        row_bits = img.size[0] * 3
+        first_bit = start * 8
+        end_bit = (start + count) * 8
+        
+        # Only decode the rows that hold the requested bits
+        top = first_bit // row_bits
+        bottom = -(-end_bit // row_bits)
+        band = img.crop((0, top, img.size[0], bottom))
+        flat = np.ascontiguousarray(band, dtype=np.uint8).reshape(-1)
+        
+        offset = first_bit - top * row_bits
+        bits = _extract_lsb(flat)[offset:offset + count * 8]
+        return np.packbits(bits).tobytes()
+    
+    def _scan_for_delimiter(self, img):
+        """Return the LSB bytes before the delimiter, or None if it isn't found"""
+        width, height = img.size
+        delimiter = self._delimiter_bytes
+        
+        # Pack LSBs back into bytes one band of rows at a time, stopping at the delimiter.
+        # A full band holds BAND_HEIGHT * 3 bits per column, a whole number of bytes, so
+        # bytes never straddle bands and only the last band can end mid-byte.
+        extracted = bytearray()
+        
+        for top in range(0, height, BAND_HEIGHT):
+            band = img.crop((0, top, width, min(top + BAND_HEIGHT, height)))
+            flat = np.ascontiguousarray(band, dtype=np.uint8).reshape(-1)
+            usable = flat.size - flat.size % 8
+            extracted += np.packbits(_extract_lsb(flat[:usable])).tobytes()
+            
+            # Only search the new bytes (plus overlap in case the delimiter straddles bands)
+            search_from = max(0, len(extracted) - usable // 8 - len(delimiter) + 1)
+            end = extracted.find(delimiter, search_from)
+            if end != -1:
+                return bytes(extracted[:end])
+        
+        return None
+    
+    def analyze_image_capacity(self, image_path, chi_square=False):
+        """Analyze how much data an image can hold
+        
+        With chi_square=True the pixels are also decoded to run the sequential
+        chi-square test over growing prefixes of the LSB stream, in embedding order.
+        """
         try:
-            img = Image.open(image_path)
-            width, height = img.size
+            # Only the header is needed for the size, pixels are only decoded for the chi-square report
+            with Image.open(image_path) as img:
+                width, height = img.size
+                if chi_square:
+                    img.load()
+                    if img.mode != 'RGB':
+                        img = img.convert('RGB')
+                    prefixes = self._chi_square_prefixes(img)
             
             # Calculate capacity (3 bits per pixel for RGB)
             max_bits = width * height * 3
@@ -153,13 +371,55 @@ class SteganographyTool:
             print(f"  Dimensions: {width}x{height}")
             print(f"  Maximum bits: {max_bits}")
             print(f"  Maximum characters: {max_chars}")
-            print(f"  Maximum message length: ~{max_chars - len(self.delimiter)} characters")
+            print(f"  Maximum message length: ~{max_chars - HEADER.size} characters")
+            print(f"  With --password: ~{max_chars - HEADER.size - NONCE_SIZE - TAG_SIZE} characters "
+                  f"(nonce and tag add {NONCE_SIZE + TAG_SIZE} bytes)")
+            print("  (Messages are zlib-compressed, so plain text usually fits 2-4x more)")
+            
+            if chi_square:
+                print("  Sequential chi-square test (Westfeld & Pfitzmann), prefixes in embedding order:")
+                step = -(-len(prefixes) // CHI_SQUARE_ROWS)
+                shown = prefixes[step - 1::step]
+                if shown[-1] is not prefixes[-1]:
+                    shown.append(prefixes[-1])
+                for bits, (red, green, blue) in shown:
+                    print(f"    First {bits:>10} bits: embedding probability "
+                          f"R {red:.2f}  G {green:.2f}  B {blue:.2f}")
+                
+                # Largest prefix before any channel crosses the threshold
+                clean_bits = 0
+                for bits, probabilities in prefixes:
+                    if max(probabilities) >= CHI_SQUARE_THRESHOLD:
+                        break
+                    clean_bits = bits
+                print(f"  Largest prefix below embedding probability {CHI_SQUARE_THRESHOLD}: "
+                      f"{clean_bits} bits ({clean_bits / max_bits:.0%} of capacity)")
             
             return max_chars
             
         except Exception as e:
             print(f"✗ Error analyzing image: {str(e)}")
             return 0
+    
+    def _chi_square_prefixes(self, img):
+        """Run the chi-square test on growing prefixes of an RGB image, one band at a time
+        
+        Returns (bits, (red, green, blue)) for each prefix, where bits is the number of
+        LSBs in the prefix and the tuple holds each channel's embedding probability.
+        """
+        width, height = img.size
+        offsets = np.array([0, 256, 512], dtype=np.uint16)  # Separate histogram bins per channel
+        counts = np.zeros(768, dtype=np.int64)
+        prefixes = []
+        
+        for top in range(0, height, BAND_HEIGHT):
+            bottom = min(top + BAND_HEIGHT, height)
+            band = np.asarray(img.crop((0, top, width, bottom)), dtype=np.uint8).reshape(-1, 3)
+            counts += np.bincount((band + offsets).reshape(-1), minlength=768)
+            probabilities = tuple(_chi_square_lsb(counts[c * 256:(c + 1) * 256])[2] for c in range(3))
+            prefixes.append((bottom * width * 3, probabilities))
+        
+        return prefixes
 
 def main():
     tool = SteganographyTool()
@@ -187,14 +447,22 @@ Examples:
     hide_parser.add_argument('input_image', help='Input image file')
     hide_parser.add_argument('message', help='Message to hide')
     hide_parser.add_argument('output_image', help='Output image file (recommended: .png)')
+    hide_parser.add_argument('--fast', action='store_true',
+                             help='Faster PNG encoding (zlib level 1) at the cost of a larger file')
+    hide_parser.add_argument('--password', action='store_true',
+                             help='Encrypt the message with AES (prompts, or reads $HIDEER_PASSWORD)')
     
     # Extract command
     extract_parser = subparsers.add_parser('extract', help='Extract message from an image')
     extract_parser.add_argument('input_image', help='Image with hidden message')
+    extract_parser.add_argument('--password', action='store_true',
+                                help='Decrypt an encrypted message (prompts, or reads $HIDEER_PASSWORD)')
     
     # Analyze command
     analyze_parser = subparsers.add_parser('analyze', help='Analyze image capacity')
     analyze_parser.add_argument('input_image', help='Image to analyze')
+    analyze_parser.add_argument('--chi-square', action='store_true',
+                                help='Also report LSB chi-square detectability (decodes all pixels)')
     
     args = parser.parse_args()
     
@@ -207,15 +475,29 @@ Examples:
         print(f"✗ Error: Input file '{args.input_image}' not found")
         return
     
+    # Read the password from the environment or prompt for it, never from the command line
+    password = None
+    if getattr(args, 'password', False):
+        password = os.environ.get('HIDEER_PASSWORD')
+        if not password and sys.stdin is not None:
+            try:
+                password = getpass.getpass('Password: ')
+            except EOFError:
+                print()  # End the prompt line
+        if not password:
+            print("✗ Error: A non-empty password is required")
+            return
+    
     # Execute commands
     if args.command == 'hide':
-        tool.hide_message(args.input_image, args.message, args.output_image)
+        tool.hide_message(args.input_image, args.message, args.output_image,
+                          fast=args.fast, password=password)
         
     elif args.command == 'extract':
-        tool.extract_message(args.input_image)
+        tool.extract_message(args.input_image, password=password)
         
     elif args.command == 'analyze':
-        tool.analyze_image_capacity(args.input_image)
+        tool.analyze_image_capacity(args.input_image, chi_square=args.chi_square)
 
 if __name__ == "__main__":
     print("🔐 Image Steganography Tool")